@@ -13,8 +13,11 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 from cryptography.fernet import Fernet
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import cryptography
 from tqdm import tqdm
+import hashlib
 import base64
 import os
 
@@ -23,6 +26,8 @@ load_dotenv()  # take environment variables from .env.
 
 DB_PASSWORD = os.getenv("DB_PASSWORD", None)
 DB_KEY = None
+# Passwords of earlier keys, used to read entries not yet rotated
+DB_OLD_PASSWORDS = []
 
 current_module_path = get_current_module_path()
 
@@ -51,9 +56,26 @@ def create_arg_parser():
                         type=str,
                         required=False,
                         help='Password for the database')
+
+    parser.add_argument('--old-db-password',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='Password of an earlier key, used to read entries encrypted with it. Can be given multiple times.')
+
+    parser.add_argument('--rotate-password',
+                        type=str,
+                        metavar='NEW_DB_PASSWORD',
+                        help='Re-encrypt every entry in the database with a new password')
+
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker threads used by --rotate-password')
     return parser
 
 
+@lru_cache(maxsize=None)
 def get_key_from_pass(password_provided=DB_PASSWORD) -> bytes:
     """Function to generate a key from the password
     Args:
@@ -79,6 +101,56 @@ def get_key_from_pass(password_provided=DB_PASSWORD) -> bytes:
     return key
 
 
+def get_key_version(key) -> str:
+    """Function to generate a short tag identifying a key
+    Args:
+        key (bytes): key generated from the password
+    Returns:
+        str: key version tag stored alongside each entry
+    """
+    return hashlib.sha256(key).hexdigest()[:12]
+
+
+def get_keyring(passwords) -> dict:
+    """Function to build a lookup of ciphers by key version
+    Args:
+        passwords (list): passwords to derive the keys from,
+                            the first one being the current password
+    Returns:
+        dict: key version mapped to its Fernet cipher
+    """
+    keyring = {}
+    for password in passwords:
+        key = get_key_from_pass(password)
+        keyring.setdefault(get_key_version(key), Fernet(key))
+    return keyring
+
+
+def decrypt_entry(entry, keyring):
+    """Function to decrypt a single database entry
+    Entries without a key version tag are tried against every key.
+    Args:
+        entry (dict): database entry with the encrypted variables
+        keyring (dict): key version mapped to its Fernet cipher
+    Returns:
+        bytes: decrypted env file content, None if no key matches
+    """
+    key_version = entry.get("key_version")
+    if key_version is not None:
+        ciphers = [keyring[key_version]] if key_version in keyring else []
+    else:
+        ciphers = list(keyring.values())
+    for cipher_suite in ciphers:
+        try:
+            return cipher_suite.decrypt(entry["variables"].encode())
+        except (
+            cryptography.fernet.InvalidToken,
+            cryptography.exceptions.InvalidSignature
+        ):
+            continue
+    return None
+
+
 def retrieve_all_backup_keys() -> list:
     """Function to retrieve all backup keys
     Returns:
@@ -99,7 +171,8 @@ def store_encrypted(date_id, env_file):
     """
     all_keys = retrieve_all_backup_keys()
     # Create a cipher object and encrypt the env values
-    cipher_suite = Fernet(get_key_from_pass())
+    key = get_key_from_pass(DB_PASSWORD)
+    cipher_suite = Fernet(key)
     cipher_text = cipher_suite.encrypt(env_file.encode())
     if date_id in all_keys:
         # Remove the old entry
@@ -107,7 +180,8 @@ def store_encrypted(date_id, env_file):
     # Store it in tinyDB
     db.insert({
         "date_id": date_id,
-        "variables": cipher_text.decode()
+        "variables": cipher_text.decode(),
+        "key_version": get_key_version(key)
     })
 
 
@@ -121,16 +195,12 @@ def retrieve_decrypted(date_id) -> str:
     """
     # Query the DB for the key
     User = Query()
-    encrypted_data = db.search(User.date_id == date_id)[0]["variables"]
-
-    # Create a cipher object and decrypt the data
-    cipher_suite = Fernet(get_key_from_pass())
-    try:
-        plain_text = cipher_suite.decrypt(encrypted_data.encode())
-    except (
-        cryptography.fernet.InvalidToken,
-        cryptography.exceptions.InvalidSignature
-    ):
+    entry = db.search(User.date_id == date_id)[0]
+
+    # Pick the cipher matching the key version of the entry and decrypt
+    keyring = get_keyring([DB_PASSWORD, *DB_OLD_PASSWORDS])
+    plain_text = decrypt_entry(entry, keyring)
+    if plain_text is None:
         print("Invalid password. Please check the password and try again.")
         return False
     return plain_text.decode()
@@ -209,14 +279,66 @@ def restore_all():
         restore_one(key)
 
 
+def rotate_password(new_password, workers=None):
+    """ Function to re-encrypt all the entries with a new password
+    Entries are decrypted with the current (or an old) password and
+    encrypted with the new one in memory, then the database is written
+    back in a single pass. Entries that cannot be decrypted with any of
+    the known passwords are kept as they are.
+    Args:
+        new_password (str): password to re-encrypt the entries with
+        workers (int, optional): number of worker threads.
+                                    Defaults to the executor's default.
+    """
+    keyring = get_keyring([DB_PASSWORD, *DB_OLD_PASSWORDS])
+    new_key = get_key_from_pass(new_password)
+    new_key_version = get_key_version(new_key)
+    new_cipher_suite = Fernet(new_key)
+
+    def reencrypt(entry):
+        if entry.get("key_version") == new_key_version:
+            return entry, True
+        plain_text = decrypt_entry(entry, keyring)
+        if plain_text is None:
+            return entry, False
+        return {
+            "date_id": entry["date_id"],
+            "variables": new_cipher_suite.encrypt(plain_text).decode(),
+            "key_version": new_key_version
+        }, True
+
+    entries = db.all()
+    print("Re-encrypting the .env files:")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(tqdm(executor.map(reencrypt, entries),
+                            total=len(entries)))
+
+    # Write the whole table back at once, keeping the document IDs
+    data = db.storage.read() or {}
+    data[db.default_table_name] = {
+        str(old.doc_id): dict(new) for old, (new, _) in zip(entries, results)
+    }
+    db.storage.write(data)
+    db.clear_cache()
+
+    skipped = [new["date_id"] for new, ok in results if not ok]
+    for date_id in skipped:
+        print(f"Could not decrypt {date_id}, kept with its old key.")
+    print(f"Re-encrypted {len(entries) - len(skipped)} of "
+          f"{len(entries)} entries.")
+
+
 if __name__ == "__main__":
     parser = create_arg_parser()
     args = parser.parse_args()
     if args.db_password:
         DB_PASSWORD = args.db_password
+    DB_OLD_PASSWORDS = args.old_db_password
     if DB_PASSWORD is None:
         raise Exception("DB_PASSWORD environment variable is not set.")
-    if args.backup:
+    if args.rotate_password:
+        rotate_password(args.rotate_password, workers=args.workers)
+    elif args.backup:
         backup()
     elif args.restore:
         restore_one(args.restore)